@@ -1,17 +1,37 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+import redis.asyncio as redis
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 MONGO_URL=os.getenv('MONGO_URL')
+REDIS_URL=os.getenv('REDIS_URL', 'redis://localhost:6379/0')
 
-client = AsyncIOMotorClient(MONGO_URL)
+# Explicit pool sizing: a nonzero minPoolSize keeps warm connections ready so
+# requests after a cold start or idle period don't pay connection setup
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    maxPoolSize=50,
+    minPoolSize=10,
+    maxIdleTimeMS=30000,
+    serverSelectionTimeoutMS=2000,
+    waitQueueTimeoutMS=2000,
+)
 
 db = client["game_server"]
 
+redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+
 async def get_database():
     """
     Get the database instance.
     This function is used to provide database access to other parts of the application.
     """
     return db
+
+async def get_redis():
+    """
+    Get the Redis client instance.
+    Used for the hot matchmaking queue state.
+    """
+    return redis_client
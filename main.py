@@ -1,14 +1,30 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from routes import player
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
 from routes.matchmaking import router as matchmaking_router
+from utils.match_helper import MatchmakingQueue
+from database import get_database, get_redis
 
 load_dotenv()
 FRONTEND_URL=os.getenv('FRONTEND_URL')
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    matchmaking = MatchmakingQueue(await get_database(), await get_redis())
+    # Pre-warm both connections so the first request doesn't pay setup latency
+    await matchmaking.db.command("ping")
+    await matchmaking.matches_collection.estimated_document_count()
+    await matchmaking.redis.ping()
+    app.state.matchmaking = matchmaking
+    yield
+
+# orjson serializes responses (datetimes included) far faster than stdlib json
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 origins = [
         "http://localhost:5173",
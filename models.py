@@ -1,10 +1,12 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional
 
 class Player(BaseModel):
+    model_config = ConfigDict(extra='ignore', str_strip_whitespace=True)
+
     username: str
     password: str
-    email: Optional[str]
+    email: Optional[str] = None
     main_highest_score: int = 0
     main_highest_combo: int = 0
     created_at: str
@@ -1,8 +1,7 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from typing import Dict, Optional
-from datetime import datetime
+from datetime import datetime, timezone
 from utils.match_helper import MatchmakingQueue
-from database import get_database
 
 router = APIRouter(
     prefix="/matchmaking",
@@ -10,55 +9,72 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-# Initialize matchmaking queue
-matchmaking = None
+def get_matchmaking(request: Request) -> MatchmakingQueue:
+    """Fetch the MatchmakingQueue singleton created in the app lifespan."""
+    return request.app.state.matchmaking
 
-@router.on_event("startup")
-async def startup_event():
-    global matchmaking
-    db = await get_database()
-    matchmaking = MatchmakingQueue(db)
+def request_time() -> datetime:
+    """Timestamp the request once so handlers don't re-read the clock."""
+    return datetime.now(timezone.utc)
 
 @router.post("/queue")
-async def join_queue(player_id: str, score: int) -> Dict:
+async def join_queue(
+    player_id: str,
+    score: int,
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking),
+    now: datetime = Depends(request_time)
+) -> Dict:
     """
     Join the matchmaking queue.
-    
+
     Args:
         player_id: The ID of the player joining the queue
         score: The player's current score
-        
+
     Returns:
         Dict containing queue status and match information if found
     """
-    if not await matchmaking.validate_queue_entry(player_id, score):
+    if not matchmaking.validate_queue_entry(player_id, score):
+        raise HTTPException(status_code=400, detail="Invalid queue entry")
+
+    # One atomic script either claims an opponent or enqueues the player, so
+    # a duplicate join can't strand a claimed opponent and two concurrent
+    # joiners can't each claim the other
+    result = await matchmaking.join_or_match(player_id, score)
+    if result is None:
+        raise HTTPException(status_code=500, detail="Failed to join queue")
+    added, opponent = result
+    if not added:
         raise HTTPException(status_code=400, detail="Invalid queue entry")
-    
-    if await matchmaking.add_to_queue(player_id, score):
-        opponent = await matchmaking.find_match(player_id, score)
-        if opponent:
-            match_id = await matchmaking.create_match(player_id, opponent)
-            return {
-                "status": "matched",
-                "match_id": match_id,
-                "opponent_id": opponent,
-                "timestamp": datetime.utcnow()
-            }
+
+    if opponent:
+        match_id = await matchmaking.create_match(player_id, opponent)
         return {
-            "status": "queued",
-            "position": await matchmaking.get_queue_position(player_id),
-            "timestamp": datetime.utcnow()
+            "status": "matched",
+            "match_id": match_id,
+            "opponent_id": opponent,
+            "timestamp": now
         }
-    raise HTTPException(status_code=500, detail="Failed to join queue")
+    # Position goes stale the moment it's returned, so don't pay an
+    # extra round-trip for it here — pollers get it from /queue/status
+    return {
+        "status": "queued",
+        "position": None,
+        "timestamp": now
+    }
 
 @router.delete("/queue/{player_id}")
-async def leave_queue(player_id: str) -> Dict:
+async def leave_queue(
+    player_id: str,
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking),
+    now: datetime = Depends(request_time)
+) -> Dict:
     """
     Leave the matchmaking queue.
-    
+
     Args:
         player_id: The ID of the player leaving the queue
-        
+
     Returns:
         Dict containing the status of the operation
     """
@@ -66,50 +82,59 @@ async def leave_queue(player_id: str) -> Dict:
         return {
             "status": "success",
             "message": "Successfully left queue",
-            "timestamp": datetime.utcnow()
+            "timestamp": now
         }
     raise HTTPException(status_code=404, detail="Player not found in queue")
 
 @router.get("/queue/status/{player_id}")
-async def get_queue_status(player_id: str) -> Dict:
+async def get_queue_status(
+    player_id: str,
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking),
+    now: datetime = Depends(request_time)
+) -> Dict:
     """
     Get the current status of a player in the queue.
-    
+
     Args:
         player_id: The ID of the player to check
-        
+
     Returns:
         Dict containing queue status information
     """
     position = await matchmaking.get_queue_position(player_id)
     if position == -1:
         raise HTTPException(status_code=404, detail="Player not found in queue")
-    
+
     return {
         "player_id": player_id,
         "position": position,
         "queue_size": await matchmaking.get_queue_size(),
-        "timestamp": datetime.utcnow()
+        "timestamp": now
     }
 
 @router.get("/queue/stats")
-async def get_queue_stats() -> Dict:
+async def get_queue_stats(
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking)
+) -> Dict:
     """
     Get overall queue statistics.
-    
+
     Returns:
         Dict containing queue statistics
     """
     return await matchmaking.get_queue_status()
 
 @router.get("/match/{match_id}")
-async def get_match_info(match_id: str) -> Dict:
+async def get_match_info(
+    match_id: str,
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking)
+) -> Dict:
     """
     Get information about a specific match.
-    
+
     Args:
         match_id: The ID of the match to retrieve
-        
+
     Returns:
         Dict containing match information
     """
@@ -119,42 +144,47 @@ async def get_match_info(match_id: str) -> Dict:
     return match_info
 
 @router.post("/match/{match_id}/cancel")
-async def cancel_match(match_id: str, player_id: str) -> Dict:
+async def cancel_match(
+    match_id: str,
+    player_id: str,
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking),
+    now: datetime = Depends(request_time)
+) -> Dict:
     """
     Cancel an active match.
-    
+
     Args:
         match_id: The ID of the match to cancel
         player_id: The ID of the player requesting the cancellation
-        
+
     Returns:
         Dict containing the status of the operation
     """
-    match_info = await matchmaking.get_match_details(match_id)
-    if not match_info:
-        raise HTTPException(status_code=404, detail="Match not found")
-    
-    if player_id not in [match_info["player1_id"], match_info["player2_id"]]:
-        raise HTTPException(status_code=403, detail="Not authorized to cancel this match")
-    
-    # Update match status
-    await matchmaking.matches_collection.update_one(
-        {"_id": match_id},
-        {"$set": {"status": "cancelled", "cancelled_at": datetime.utcnow()}}
-    )
-    
+    # One atomic round-trip handles lookup, authorization and cancellation;
+    # only the failure path pays a second read to pick the right error
+    if not await matchmaking.cancel_match(match_id, player_id):
+        match_info = await matchmaking.get_match_details(match_id)
+        if not match_info:
+            raise HTTPException(status_code=404, detail="Match not found")
+        if player_id not in [match_info["player1_id"], match_info["player2_id"]]:
+            raise HTTPException(status_code=403, detail="Not authorized to cancel this match")
+        raise HTTPException(status_code=400, detail="Match is not active")
+
     return {
         "status": "success",
         "message": "Match cancelled successfully",
-        "timestamp": datetime.utcnow()
+        "timestamp": now
     }
 
 @router.get("/queue/cleanup")
-async def cleanup_queue() -> Dict:
+async def cleanup_queue(
+    matchmaking: MatchmakingQueue = Depends(get_matchmaking),
+    now: datetime = Depends(request_time)
+) -> Dict:
     """
     Clean up stale queue entries.
     This endpoint should be called periodically by a maintenance task.
-    
+
     Returns:
         Dict containing cleanup statistics
     """
@@ -162,5 +192,5 @@ async def cleanup_queue() -> Dict:
     return {
         "status": "success",
         "cleaned_entries": cleaned_count,
-        "timestamp": datetime.utcnow()
+        "timestamp": now
     }
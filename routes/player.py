@@ -15,12 +15,14 @@ router = APIRouter()
 
 @router.post("/players/")
 async def create_player(player: Player):
-    if await db.players.find_one({"username": player.username}):
+    # Existence check only — project down to _id so no document body is
+    # fetched or decoded
+    if await db.players.find_one({"username": player.username}, {"_id": 1}):
         raise HTTPException(status_code=400, detail="Player already exists")
     
     # Hash the password before storing
-    player_dict = player.dict()
-    player_dict["password"] = get_password_hash(player_dict["password"])
+    player_dict = player.model_dump()
+    player_dict["password"] = await get_password_hash(player_dict["password"])
     
     result = await db.players.insert_one(player_dict)
     return {"id": str(result.inserted_id)}
@@ -28,7 +30,7 @@ async def create_player(player: Player):
 @router.post("/token", response_model=Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
     player = await db.players.find_one({"username": form_data.username})
-    if not player or not verify_password(form_data.password, player["password"]):
+    if not player or not await verify_password(form_data.password, player["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -47,7 +49,8 @@ async def read_players_me(current_player: Player = Depends(get_current_player)):
 
 @router.get("/players/{username}")
 async def get_player(username: str):
-    player = await db.players.find_one({"username": username})
+    # Never fetch the password hash for a public profile lookup
+    player = await db.players.find_one({"username": username}, {"password": 0})
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     player["_id"] = str(player["_id"])
@@ -1,95 +1,208 @@
+import asyncio
+import json
 from typing import Optional, Dict, List, Tuple
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference, ReturnDocument
+from redis.asyncio import Redis
 from bson import ObjectId
+from bson.errors import InvalidId
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def _cache_default(value):
+    """JSON fallback for cached responses.
+
+    Datetimes become RFC3339 via isoformat() so a cache hit emits the exact
+    format orjson produces for the uncached datetime objects.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
 # Constants
 MAX_SCORE_DIFFERENCE = 100  # Maximum score difference for initial matching
 QUEUE_TIMEOUT_MINUTES = 5   # Time before expanding matchmaking criteria
 EXPANDED_SCORE_DIFFERENCE = 200  # Score difference after timeout
 
+# Redis keys for the hot queue. Both sorted sets hold the same members:
+# one ordered by score for matching, one by join time for position/staleness.
+QUEUE_BY_SCORE_KEY = "queue:waiting"
+QUEUE_BY_JOINED_KEY = "queue:joined"
+
+# Running sum of queued players' scores, maintained on add/remove so
+# get_queue_status never has to scan the whole queue for the average
+QUEUE_SCORE_SUM_KEY = "queue:score_sum"
+SCORE_SUM_REFRESH_SECONDS = 30  # How often to recompute the sum to correct drift
+
+# Response caches: stats are cached briefly so polling can't hammer the queue,
+# and finished matches are immutable so they cache for a long time
+STATS_CACHE_KEY = "stats:queue"
+STATS_CACHE_TTL_SECONDS = 1
+MATCH_CACHE_KEY = "match:{}"
+MATCH_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Atomic join-or-match: either claims one waiting opponent or enqueues the
+# joiner, in a single script. Doing both sides in one atomic step closes the
+# reciprocal race where two players joining concurrently each claim the other
+# and end up in two different matches for the same pair.
+# KEYS: score zset, joined zset, score sum
+# ARGV: player_id, score, joined_at timestamp, initial delta, expanded delta
+# Returns: {0} already queued, {1, opponent} matched, {2} queued
+JOIN_OR_MATCH_SCRIPT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) then return {0} end
+local score = tonumber(ARGV[2])
+for i = 4, 5 do
+    local delta = tonumber(ARGV[i])
+    local candidates = redis.call('ZRANGEBYSCORE', KEYS[1],
+        score - delta, score + delta, 'WITHSCORES', 'LIMIT', 0, 1)
+    if #candidates > 0 then
+        redis.call('ZREM', KEYS[1], candidates[1])
+        redis.call('ZREM', KEYS[2], candidates[1])
+        redis.call('INCRBY', KEYS[3], -math.floor(candidates[2]))
+        return {1, candidates[1]}
+    end
+end
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[3]), ARGV[1])
+redis.call('INCRBY', KEYS[3], score)
+return {2}
+"""
+
+# Server-side stale sweep: ZSET members can't carry TTLs the way a Mongo TTL
+# index expires documents, so expire them in one atomic script instead of
+# shipping the member list back and forth.
+# KEYS: joined zset, score zset, score sum; ARGV: cutoff timestamp
+CLEAN_STALE_SCRIPT = """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #stale == 0 then return 0 end
+local sum = 0
+for _, member in ipairs(stale) do
+    local score = redis.call('ZSCORE', KEYS[2], member)
+    if score then sum = sum + score end
+end
+-- unpack() is bounded by Lua's stack (~8000 values), so remove in chunks
+-- rather than erroring out exactly when the backlog is largest
+for i = 1, #stale, 1000 do
+    local chunk = {}
+    for j = i, math.min(i + 999, #stale) do
+        chunk[#chunk + 1] = stale[j]
+    end
+    redis.call('ZREM', KEYS[1], unpack(chunk))
+    redis.call('ZREM', KEYS[2], unpack(chunk))
+end
+if sum > 0 then redis.call('INCRBY', KEYS[3], -math.floor(sum)) end
+return #stale
+"""
+
 class MatchmakingQueue:
-    def __init__(self, db_client: AsyncIOMotorClient):
+    def __init__(self, db_client: AsyncIOMotorClient, redis_client: Redis):
         self.db = db_client
-        self.queue_collection = self.db.queue
+        self.redis = redis_client
         self.matches_collection = self.db.matches
+        # Read-only match lookups can go to a secondary, keeping the primary
+        # free for writes; with no replica set this falls back to the primary
+        self.matches_ro = self.matches_collection.with_options(
+            read_preference=ReadPreference.SECONDARY_PREFERRED
+        )
+        self._score_sum_refreshed_at = datetime.min
+        self._join_or_match_script = self.redis.register_script(JOIN_OR_MATCH_SCRIPT)
+        self._clean_stale_script = self.redis.register_script(CLEAN_STALE_SCRIPT)
+
+    async def add_to_queue(self, player_id: str, score: int) -> Optional[bool]:
+        """Add a player to the matchmaking queue.
+
+        ZADD NX doubles as the "already waiting" check: a player who is
+        already queued leaves the sorted set untouched and we report failure
+        without any extra round-trip. All three writes ride one pipeline, so
+        a join costs a single network round-trip.
 
-    async def add_to_queue(self, player_id: str, score: int) -> bool:
-        """Add a player to the matchmaking queue."""
+        Returns True if added, False if the player was already waiting, and
+        None on a backend failure so callers can tell a client error from an
+        infrastructure one.
+        """
         try:
-            queue_entry = {
-                "player_id": player_id,
-                "score": score,
-                "joined_at": datetime.utcnow(),
-                "status": "waiting"
-            }
-            await self.queue_collection.update_one(
-                {"player_id": player_id},
-                {"$set": queue_entry},
-                upsert=True
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zadd(QUEUE_BY_SCORE_KEY, {player_id: score}, nx=True)
+            pipe.zadd(
+                QUEUE_BY_JOINED_KEY,
+                # Aware datetime: naive utcnow().timestamp() reinterprets
+                # the value in the host's local timezone
+                {player_id: datetime.now(timezone.utc).timestamp()},
+                nx=True
             )
+            pipe.incrby(QUEUE_SCORE_SUM_KEY, score)
+            added, _, _ = await pipe.execute()
+            if not added:
+                # Player is already waiting; undo the optimistic sum bump
+                await self.redis.incrby(QUEUE_SCORE_SUM_KEY, -score)
+                return False
             return True
         except Exception as e:
             logger.error(f"Error adding player to queue: {e}")
-            return False
+            return None
 
     async def remove_from_queue(self, player_id: str) -> bool:
         """Remove a player from the matchmaking queue."""
         try:
-            result = await self.queue_collection.delete_one({"player_id": player_id})
-            return result.deleted_count > 0
+            # ZSCORE runs server-side before the ZREMs in the same pipeline,
+            # so the score needed for the sum decrement costs no extra trip
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.zscore(QUEUE_BY_SCORE_KEY, player_id)
+            pipe.zrem(QUEUE_BY_SCORE_KEY, player_id)
+            pipe.zrem(QUEUE_BY_JOINED_KEY, player_id)
+            score, removed, _ = await pipe.execute()
+            if removed and score is not None:
+                await self.redis.incrby(QUEUE_SCORE_SUM_KEY, -int(score))
+            return removed > 0
         except Exception as e:
             logger.error(f"Error removing player from queue: {e}")
             return False
 
     async def get_queue_position(self, player_id: str) -> int:
-        """Get player's position in the queue."""
+        """Get player's position in the queue (FIFO by join time)."""
         try:
-            player = await self.queue_collection.find_one({"player_id": player_id})
-            if not player:
+            rank = await self.redis.zrank(QUEUE_BY_JOINED_KEY, player_id)
+            if rank is None:
                 return -1
-            
-            # Count players who joined before this player
-            position = await self.queue_collection.count_documents({
-                "joined_at": {"$lt": player["joined_at"]}
-            })
-            return position + 1
+            return rank + 1
         except Exception as e:
             logger.error(f"Error getting queue position: {e}")
             return -1
 
-    async def find_match(self, player_id: str, score: int) -> Optional[str]:
-        """Find a suitable opponent for the player."""
-        try:
-            # First try to find a match within the initial score difference
-            match = await self.queue_collection.find_one({
-                "player_id": {"$ne": player_id},
-                "status": "waiting",
-                "score": {
-                    "$gte": score - MAX_SCORE_DIFFERENCE,
-                    "$lte": score + MAX_SCORE_DIFFERENCE
-                }
-            })
+    async def join_or_match(self, player_id: str, score: int) -> Optional[Tuple[bool, Optional[str]]]:
+        """Atomically match the player or add them to the queue.
 
-            if not match:
-                # If no match found, try with expanded criteria
-                match = await self.queue_collection.find_one({
-                    "player_id": {"$ne": player_id},
-                    "status": "waiting",
-                    "score": {
-                        "$gte": score - EXPANDED_SCORE_DIFFERENCE,
-                        "$lte": score + EXPANDED_SCORE_DIFFERENCE
-                    }
-                })
-
-            return match["player_id"] if match else None
+        The claim-or-enqueue decision happens inside one Lua script, so a
+        joiner either walks away with an opponent (who is removed from the
+        queue in the same step) or is enqueued — never both, and never the
+        reciprocal race where two concurrent joiners each claim the other.
+
+        Returns (added, opponent_id): (False, None) if the player was
+        already waiting, (True, opponent) on a match, (True, None) if
+        queued. Returns None on a backend failure.
+        """
+        try:
+            result = await self._join_or_match_script(
+                keys=[QUEUE_BY_SCORE_KEY, QUEUE_BY_JOINED_KEY, QUEUE_SCORE_SUM_KEY],
+                args=[
+                    player_id,
+                    score,
+                    datetime.now(timezone.utc).timestamp(),
+                    MAX_SCORE_DIFFERENCE,
+                    EXPANDED_SCORE_DIFFERENCE
+                ]
+            )
+            if result[0] == 0:
+                return (False, None)
+            if result[0] == 1:
+                return (True, result[1])
+            return (True, None)
         except Exception as e:
-            logger.error(f"Error finding match: {e}")
+            logger.error(f"Error joining queue: {e}")
             return None
 
     def calculate_score_difference(self, player1_score: int, player2_score: int) -> int:
@@ -103,34 +216,64 @@ class MatchmakingQueue:
     async def get_queue_size(self) -> int:
         """Get current number of players in queue."""
         try:
-            return await self.queue_collection.count_documents({"status": "waiting"})
+            return await self.redis.zcard(QUEUE_BY_SCORE_KEY)
         except Exception as e:
             logger.error(f"Error getting queue size: {e}")
             return 0
 
     async def get_queue_status(self) -> Dict:
-        """Get detailed queue status."""
+        """Get detailed queue status.
+
+        Reads the maintained score-sum counter instead of scanning every
+        queue entry, so stats polling stays O(1) regardless of queue size.
+        The whole response is additionally cached for a second, so the
+        backing reads happen at most once per second however hard clients
+        poll.
+        """
         try:
-            total = await self.get_queue_size()
-            avg_score = await self.queue_collection.aggregate([
-                {"$match": {"status": "waiting"}},
-                {"$group": {"_id": None, "avg_score": {"$avg": "$score"}}}
-            ]).to_list(1)
-            
-            return {
+            cached = await self.redis.get(STATS_CACHE_KEY)
+            if cached:
+                return json.loads(cached)
+
+            await self._refresh_score_sum_if_stale()
+            total = await self.redis.zcard(QUEUE_BY_SCORE_KEY)
+            score_sum = int(await self.redis.get(QUEUE_SCORE_SUM_KEY) or 0)
+            avg_score = score_sum / total if total else 0
+
+            status = {
                 "total_players": total,
-                "average_score": avg_score[0]["avg_score"] if avg_score else 0,
+                "average_score": avg_score,
                 "timestamp": datetime.utcnow()
             }
+            await self.redis.set(
+                STATS_CACHE_KEY,
+                json.dumps(status, default=_cache_default),
+                ex=STATS_CACHE_TTL_SECONDS
+            )
+            return status
         except Exception as e:
             logger.error(f"Error getting queue status: {e}")
             return {"total_players": 0, "average_score": 0, "timestamp": datetime.utcnow()}
 
+    async def _refresh_score_sum_if_stale(self) -> None:
+        """Periodically recompute the score sum from the queue itself.
+
+        The incremental counter can drift if a process dies between a ZREM
+        and its decrement, so rebuild it from an authoritative scan at most
+        once per SCORE_SUM_REFRESH_SECONDS.
+        """
+        now = datetime.utcnow()
+        if (now - self._score_sum_refreshed_at).total_seconds() < SCORE_SUM_REFRESH_SECONDS:
+            return
+        self._score_sum_refreshed_at = now
+        entries = await self.redis.zrange(QUEUE_BY_SCORE_KEY, 0, -1, withscores=True)
+        await self.redis.set(QUEUE_SCORE_SUM_KEY, int(sum(score for _, score in entries)))
+
     async def is_player_in_queue(self, player_id: str) -> bool:
         """Check if player is currently in queue."""
         try:
-            result = await self.queue_collection.find_one({"player_id": player_id})
-            return result is not None
+            score = await self.redis.zscore(QUEUE_BY_SCORE_KEY, player_id)
+            return score is not None
         except Exception as e:
             logger.error(f"Error checking queue status: {e}")
             return False
@@ -138,42 +281,105 @@ class MatchmakingQueue:
     async def create_match(self, player1_id: str, player2_id: str) -> str:
         """Create a new match between two players."""
         try:
-            match_id = str(ObjectId())
+            # Keep _id a native ObjectId: half the bytes of its string form
+            # and faster _id-index comparisons; stringify only for the API
             match_data = {
-                "_id": match_id,
+                "_id": ObjectId(),
                 "player1_id": player1_id,
                 "player2_id": player2_id,
                 "created_at": datetime.utcnow(),
                 "status": "active"
             }
-            await self.matches_collection.insert_one(match_data)
-            
-            # Remove both players from queue
-            await self.remove_from_queue(player1_id)
-            await self.remove_from_queue(player2_id)
-            
-            return match_id
+            # The match insert and the queue removals touch different stores
+            # and are independent, so run them concurrently (the claimed
+            # opponent is already gone, so their removal is a no-op)
+            await asyncio.gather(
+                self.matches_collection.insert_one(match_data),
+                self.remove_from_queue(player1_id),
+                self.remove_from_queue(player2_id)
+            )
+
+            return str(match_data["_id"])
         except Exception as e:
             logger.error(f"Error creating match: {e}")
             return None
 
     async def get_match_details(self, match_id: str) -> Dict:
-        """Get details of a specific match."""
+        """Get details of a specific match.
+
+        Finished matches are immutable, so they are served from a long-lived
+        Redis cache; active matches can still change (cancellation), so they
+        always go to MongoDB.
+        """
         try:
-            match = await self.matches_collection.find_one({"_id": match_id})
-            return match if match else {}
+            try:
+                object_id = ObjectId(match_id)
+            except InvalidId:
+                return {}
+
+            cache_key = MATCH_CACHE_KEY.format(match_id)
+            cached = await self.redis.get(cache_key)
+            if cached:
+                return json.loads(cached)
+
+            match = await self.matches_ro.find_one({"_id": object_id})
+            if not match:
+                return {}
+            match["_id"] = str(match["_id"])
+            if match.get("status") != "active":
+                await self.redis.set(
+                    cache_key,
+                    json.dumps(match, default=_cache_default),
+                    ex=MATCH_CACHE_TTL_SECONDS
+                )
+            return match
         except Exception as e:
             logger.error(f"Error getting match details: {e}")
             return {}
 
+    async def cancel_match(self, match_id: str, player_id: str) -> Optional[Dict]:
+        """Atomically cancel an active match on behalf of one of its players.
+
+        Authorization rides in the filter itself (the caller must be one of
+        the match's players), so the check and the status flip are a single
+        round-trip and cannot race a concurrent cancellation.
+        """
+        try:
+            try:
+                object_id = ObjectId(match_id)
+            except InvalidId:
+                return None
+
+            match = await self.matches_collection.find_one_and_update(
+                {
+                    "_id": object_id,
+                    "status": "active",
+                    "$or": [{"player1_id": player_id}, {"player2_id": player_id}]
+                },
+                {"$set": {"status": "cancelled", "cancelled_at": datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER
+            )
+            if match:
+                match["_id"] = str(match["_id"])
+                await self.redis.delete(MATCH_CACHE_KEY.format(match_id))
+            return match
+        except Exception as e:
+            logger.error(f"Error cancelling match: {e}")
+            return None
+
     async def clean_stale_queue_entries(self) -> int:
-        """Remove players who have been in queue too long."""
+        """Remove players who have been in queue too long.
+
+        The whole sweep — finding stale entries, dropping them from both
+        sorted sets and correcting the score sum — runs server-side in one
+        atomic script, so stale members are never shipped over the wire.
+        """
         try:
-            timeout_threshold = datetime.utcnow() - timedelta(minutes=QUEUE_TIMEOUT_MINUTES)
-            result = await self.queue_collection.delete_many({
-                "joined_at": {"$lt": timeout_threshold}
-            })
-            return result.deleted_count
+            timeout_threshold = datetime.now(timezone.utc) - timedelta(minutes=QUEUE_TIMEOUT_MINUTES)
+            return await self._clean_stale_script(
+                keys=[QUEUE_BY_JOINED_KEY, QUEUE_BY_SCORE_KEY, QUEUE_SCORE_SUM_KEY],
+                args=[timeout_threshold.timestamp()]
+            )
         except Exception as e:
             logger.error(f"Error cleaning stale entries: {e}")
             return 0
@@ -191,20 +397,16 @@ class MatchmakingQueue:
         except Exception as e:
             logger.error(f"Error handling queue error: {e}")
 
-    async def validate_queue_entry(self, player_id: str, score: int) -> bool:
-        """Validate player data before adding to queue."""
-        try:
-            # Check if player is already in queue
-            if await self.is_player_in_queue(player_id):
-                return False
-            
-            # Validate score is positive
-            if score < 0:
-                return False
-            
-            # Add any other validation rules here
-            
-            return True
-        except Exception as e:
-            logger.error(f"Error validating queue entry: {e}")
+    def validate_queue_entry(self, player_id: str, score: int) -> bool:
+        """Validate player data before adding to queue.
+
+        The "already in queue" check now lives in add_to_queue's ZADD NX, so
+        this is a pure in-process check with no round-trip.
+        """
+        # Validate score is positive
+        if score < 0:
             return False
+
+        # Add any other validation rules here
+
+        return True